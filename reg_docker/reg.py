@@ -24,7 +24,7 @@ from PIL import Image
 # need to increase the limit to accommodate large size images
 Image.MAX_IMAGE_PIXELS = None
 
-from skimage.feature import register_translation
+import scipy.fft
 
 import tifffile
 import psutil
@@ -33,13 +33,44 @@ import os
 import sys
 
 
-def pad_frame(f1, mx, my):
-    # pad smaller sized frames
-    if f1.shape[0] < mx:
-        f1 = np.pad(f1, [(0,mx-f1.shape[0]), (0,0)], mode='constant')
-    if f1.shape[1] < my:
-        f1 = np.pad(f1, [(0,0), (0,my-f1.shape[1])], mode='constant')
-    return f1
+def read_frame(f, mx, my, shape, dtype):
+    # read a frame straight into a 0-padded buffer of the largest frame size
+    # shape and dtype are cached by get_max_frame_size, so the buffer is allocated before the file is opened
+    out = np.zeros((mx, my) + shape[2:], dtype=dtype)
+    with tifffile.TiffFile(f, is_ome=False) as tif:
+        page = tif.pages[0]
+        if not page.is_contiguous or shape[0:2] == (mx, my):
+            # decoded tiles/strips and unpadded frames are written into the buffer in place
+            page.asarray(out=out[:shape[0], :shape[1]])
+        elif page.is_memmappable:
+            # uncompressed data is one block in the file and needs a contiguous target,
+            # it is copied from a memory map of the file into the padded buffer
+            out[:shape[0], :shape[1]] = tifffile.memmap(f, page=0, mode='r')
+        else:
+            # unaligned uncompressed data is read into a temporary frame
+            out[:shape[0], :shape[1]] = page.asarray()
+    return out
+
+
+def shift_into(out, im, dy, dx):
+    # translate im by (dy, dx) pixels into the preallocated out
+    # unlike np.roll nothing wraps around, uncovered pixels are 0
+    h, w = im.shape[0:2]
+    y0, y1 = max(dy,0), h+min(dy,0)
+    x0, x1 = max(dx,0), w+min(dx,0)
+    # zero only the uncovered border so every output pixel is written once
+    out[:y0] = 0
+    out[y1:] = 0
+    out[y0:y1, :x0] = 0
+    out[y0:y1, x1:] = 0
+    out[y0:y1, x0:x1] = im[y0-dy:y1-dy, x0-dx:x1-dx]
+    return out
+
+
+def write_frame(f, im):
+    # tiled zstd BigTIFF, tiles are compressed on all cores
+    tifffile.imwrite(f, im, bigtiff=True, tile=(512, 512), compression='zstd',
+                     compressionargs={'level': 1}, maxworkers=os.cpu_count())
 
 
 def get_max_frame_size(tif_files):
@@ -48,15 +79,87 @@ def get_max_frame_size(tif_files):
     maxy = 0
     minx = np.inf
     miny = np.inf
+    shapes = dict()
     for f in tif_files:
-        tif = tifffile.TiffFile(f)
-        x, y = tif.pages[0].shape[0:2]
+        # keep the header info so frames are not re-parsed before reading
+        with tifffile.TiffFile(f, is_ome=False) as tif:
+            shapes[f] = (tif.pages[0].shape, tif.pages[0].dtype)
+        x, y = shapes[f][0][0:2]
         print(x, y, f)
         maxx = max(maxx,x)
         maxy = max(maxy,y)
         minx = min(minx,x)
         miny = min(miny,y)
-    return maxx, maxy
+    return maxx, maxy, shapes
+
+
+def subpixel_peak(cc, peak):
+    # sub-pixel offset of the cross-correlation peak
+    # a parabola through the peak and its two neighbours along each axis, wrapping at the borders
+    # the peak is about a pixel wide, so samples further out would only pull the vertex back to the peak
+    rows = np.arange(peak[0]-1, peak[0]+2)
+    cols = np.arange(peak[1]-1, peak[1]+2)
+    p = cc.take(rows, axis=0, mode='wrap').take(cols, axis=1, mode='wrap')
+    offset = np.zeros(2)
+    dy = p[0,1] - 2*p[1,1] + p[2,1]
+    dx = p[1,0] - 2*p[1,1] + p[1,2]
+    if dy < 0:
+        offset[0] = 0.5 * (p[0,1] - p[2,1]) / dy
+    if dx < 0:
+        offset[1] = 0.5 * (p[1,0] - p[1,2]) / dx
+    return offset
+
+
+def half_weights(n):
+    # number of columns of the full spectrum each rfft column stands for, n is the real axis length
+    w = np.full(n // 2 + 1, 2.0)
+    w[0] = 1
+    if n % 2 == 0:
+        w[-1] = 1
+    return w
+
+
+def spectrum_power(F, n):
+    # sum of squares of a real frame from its rfft2 (Parseval), n is the frame's last axis length
+    return np.sum((np.abs(F)**2) @ half_weights(n).astype(np.float32)) / (F.shape[0] * n)
+
+
+def phase_correlation(F_fix, src_amp, im_mov):
+    # phase correlation of a moving frame against the rfft2 of the fixed frame and its sum of squares
+    # returns the shift registering the moving frame to the fixed one and an error estimate
+    n0, n1 = im_mov.shape
+    F_mov = scipy.fft.rfft2(im_mov, workers=-1)
+    target_amp = spectrum_power(F_mov, n1)
+
+    # the cross-power spectrum is built in place in the moving spectrum,
+    # its phase normalised copy locates the peak
+    cross = F_mov
+    np.conjugate(cross, out=cross)
+    cross *= F_fix
+    mag = np.abs(cross)
+    mag += 1e-12
+    cc = scipy.fft.irfft2(cross / mag, s=im_mov.shape, workers=-1, overwrite_x=True)
+    peak = np.unravel_index(np.argmax(cc), cc.shape)
+
+    shift = peak + subpixel_peak(cc, peak)
+
+    # shifts beyond the midpoint wrap around to negative shifts
+    dims = np.array(cc.shape)
+    shift[shift > dims // 2] -= dims[shift > dims // 2]
+
+    # error as reported by register_translation: the unnormalised cross-correlation at the peak,
+    # a single inverse DFT sample of the cross-power spectrum, against the energies of both frames
+    a = np.exp(2j * np.pi * np.arange(n0) * peak[0] / n0)
+    b = np.exp(2j * np.pi * np.arange(n1 // 2 + 1) * peak[1] / n1) * half_weights(n1)
+    CCmax = np.real(a @ (cross @ b.astype(cross.dtype))) / (n0 * n1)
+    error = np.sqrt(np.abs(1 - CCmax**2 / (src_amp * target_amp)))
+    return shift, error
+
+
+def fft_grid(mx, my, ds):
+    # shape of the down sampled frames, rounded up to sizes with small prime factors so pocketfft
+    # does not fall back to Bluestein's algorithm; all rounds share it and reuse the cached FFT plans
+    return scipy.fft.next_fast_len(-(-mx // ds)), scipy.fft.next_fast_len(-(-my // ds), real=True)
 
 
 def register_frame(im1, im2):
@@ -65,19 +168,25 @@ def register_frame(im1, im2):
     
     down_sample = larger_dim // 10000 + 1
     
-    im1d = im1[0::down_sample, 0::down_sample].copy()
-    im2d = im2[0::down_sample, 0::down_sample].copy()
+    # float32 is plenty for locating the peak and halves the FFT memory
+    small = np.zeros(fft_grid(*im1.shape[0:2], down_sample), dtype=np.float32)
+    im1d = im1[0::down_sample, 0::down_sample]
+    small[:im1d.shape[0], :im1d.shape[1]] = im1d
+    F_fix = scipy.fft.rfft2(small, workers=-1)
+    src_amp = spectrum_power(F_fix, small.shape[1])
+    # the down sampled buffer is reused for the moving frame, both frames have the same padded size
+    small[:im1d.shape[0], :im1d.shape[1]] = im2[0::down_sample, 0::down_sample]
 
     print('\nDown sampling factor:', down_sample)
+    print('FFT grid:', small.shape)
 
-    shift, error, diffphase = register_translation(im1d, im2d, upsample_factor=down_sample)
+    shift, error = phase_correlation(F_fix, src_amp, small)
     shift = shift * [down_sample,down_sample]
     
     print('Shift:',shift)
-    print('Error:',error)
-    print('Diffphase:',diffphase,'\n')
+    print('Error:',error,'\n')
     
-    im2 = np.roll(im2, shift.astype(int), [0,1])
+    im2 = shift_into(np.empty_like(im2), im2, *np.round(shift).astype(int))
     
     return im1, im2
     
@@ -91,34 +200,26 @@ def main(in_folder, out_folder):
         print('Expected two (2) TIF files in input folder.  Found:', len(tif_files))
         exit()
     
-    # check image sizes against available mem
+    # largest image size
+    mx,my,shapes = get_max_frame_size(tif_files)
+
+    # check decoded image sizes against available mem, the file size underestimates compressed frames
+    # both padded frames and the translated copy are held at once
     mem = psutil.virtual_memory()
-    tif1 = tifffile.TiffFile(tif_files[0])
-    tif2 = tifffile.TiffFile(tif_files[1])
-    tsz1 = tif1.fstat.st_size
-    tsz2 = tif2.fstat.st_size
-    if (tsz1 + tsz2) > mem.available * 0.75:
+    tsz = mx * my * max(dtype.itemsize * int(np.prod(shape[2:])) for shape, dtype in shapes.values())
+    if 3 * tsz > mem.available * 0.75:
         print('Not enough memory to read both frames.')
         exit()
-    
-    # largest image size
-    mx,my = get_max_frame_size(tif_files)
-
-    im_src = tifffile.imread(tif_files[0])
-    im_dst = tifffile.imread(tif_files[1])
-
-    im_src = np.squeeze(im_src)
-    im_dst = np.squeeze(im_dst)
 
-    im_src = pad_frame(im_src, mx, my)
-    im_dst = pad_frame(im_dst, mx, my)
+    im_src = read_frame(tif_files[0], mx, my, *shapes[tif_files[0]])
+    im_dst = read_frame(tif_files[1], mx, my, *shapes[tif_files[1]])
 
     im1, im2 = register_frame(im_src, im_dst)
     
     print('Writing frames.')
 
-    tifffile.imwrite(tif_files[0].replace(in_folder, out_folder), data=im1)
-    tifffile.imwrite(tif_files[1].replace(in_folder, out_folder), data=im2)
+    write_frame(tif_files[0].replace(in_folder, out_folder), im1)
+    write_frame(tif_files[1].replace(in_folder, out_folder), im2)
     
 
 if __name__ == '__main__':
@@ -27,6 +27,10 @@
     output/ subfolder from where the script was run.  Some frame sizes are
     inconsistent, so all frames are 0-padded to the max size of all frames.
 
+    With --backend vips frames are streamed through libvips one strip or tile
+    row at a time instead of being loaded into memory.  Frames saved as a
+    single strip are still decoded whole.
+
 '''
 
 import numpy as np
@@ -34,22 +38,113 @@ import numpy as np
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 
-from skimage.feature import register_translation
+import scipy.fft
 
 import tifffile
+import zarr
 import glob2
+import argparse
 import os
 import sys
 import psutil
+from concurrent.futures import ThreadPoolExecutor
+
+
+# output tile size
+TILE = 512
+
+
+def read_frame(f, mx, my, shape, dtype):
+    # read a frame straight into a 0-padded buffer of the largest frame size
+    # shape and dtype are cached by get_max_frame_size, so the buffer is allocated before the file is opened
+    out = np.zeros((mx, my) + shape[2:], dtype=dtype)
+    with tifffile.TiffFile(f, is_ome=False) as tif:
+        page = tif.pages[0]
+        if not page.is_contiguous or shape[0:2] == (mx, my):
+            # decoded tiles/strips and unpadded frames are written into the buffer in place
+            page.asarray(out=out[:shape[0], :shape[1]])
+        elif page.is_memmappable:
+            # uncompressed data is one block in the file and needs a contiguous target,
+            # it is copied from a memory map of the file into the padded buffer
+            out[:shape[0], :shape[1]] = tifffile.memmap(f, page=0, mode='r')
+        else:
+            # unaligned uncompressed data is read into a temporary frame
+            out[:shape[0], :shape[1]] = page.asarray()
+    return out
+
+
+def write_frame(f, data, shape=None, dtype=None):
+    # tiled zstd BigTIFF, tifffile compresses the tiles in parallel
+    # (its default worker count, frames are already written from several threads)
+    # data is a frame or an iterator of TILE x TILE tiles of the given shape and dtype,
+    # trailing dimensions are samples of a pixel, 3 or 4 samples are written as RGB(A)
+    shape = data.shape if shape is None else shape
+    photometric = 'rgb' if shape[2:] in ((3,), (4,)) else 'minisblack'
+    tifffile.imwrite(f, data, shape=shape, dtype=dtype, bigtiff=True, tile=(TILE, TILE),
+                     photometric=photometric, planarconfig='contig' if shape[2:] else None,
+                     compression='zstd', compressionargs={'level': 1})
+
+
+def shifted_tiles(z, dy, dx, mx, my):
+    # output tiles of frame z translated by (dy, dx) on the 0-padded (mx, my) canvas
+    # source rows are read one strip or tile row of z at a time, so each is decoded once
+    # however the bands of TILE output rows fall across it, nothing wraps around
+    # samples of multi-sample frames are carried along in the trailing dimensions
+    h, w = z.shape[0:2]
+    rows = z.chunks[0]
+    x0, x1 = max(dx,0), min(w+dx, my)
+    width = -(-my // TILE) * TILE
+    b0, block = None, None
+    for y in range(0, mx, TILE):
+        band = np.zeros((TILE, width) + z.shape[2:], dtype=z.dtype)
+        s0, s1 = max(y-dy, 0), min(y+TILE-dy, h, mx-dy)
+        while s0 < s1 and x0 < x1:
+            if b0 != s0 // rows * rows:
+                b0 = s0 // rows * rows
+                block = z[b0:min(b0+rows, h), x0-dx:x1-dx]
+            e = min(s1, b0+rows)
+            band[s0+dy-y:e+dy-y, x0:x1] = block[s0-b0:e-b0]
+            s0 = e
+        for x in range(0, my, TILE):
+            yield band[:, x:x+TILE]
+
+
+def write_shifted(f, dy, dx, mx, my):
+    # translate and write a single frame of a round without loading it in full, returns the output file
+    with tifffile.imread(f, aszarr=True, key=0) as store:
+        z = zarr.open(store, mode='r')
+        write_frame(f.replace('input','output'), shifted_tiles(z, dy, dx, mx, my), shape=(mx, my) + z.shape[2:], dtype=z.dtype)
+    return f.replace('input','output')
+
 
+def write_shifted_vips(f, dy, dx, mx, my):
+    # stream a frame through libvips: read -> pad and translate -> write
+    # embed places the frame at (dx, dy) on a 0 canvas, nothing wraps around,
+    # only the strips or tile rows in flight are held in memory, a single strip frame is held whole
+    # pyvips is imported here so the numpy backend runs without libvips
+    import pyvips
+    im = pyvips.Image.tiffload(f, access='sequential')
+    im = im.embed(dx, dy, my, mx, background=0)
+    im.tiffsave(f.replace('input','output'), tile=True, tile_width=TILE, tile_height=TILE,
+                compression='zstd', level=1, bigtiff=True, strip=True)
+    return f.replace('input','output')
 
-def pad_frame(f1, mx, my):
-    # pad smaller sized frames to the largest frame size
-    if f1.shape[0] < mx:
-        f1 = np.pad(f1, [(0,mx-f1.shape[0]), (0,0)], mode='constant')
-    if f1.shape[1] < my:
-        f1 = np.pad(f1, [(0,0), (0,my-f1.shape[1])], mode='constant')
-    return f1
+
+def fft_grid(mx, my, ds):
+    # shape of the down sampled frames, rounded up to sizes with small prime factors so pocketfft
+    # does not fall back to Bluestein's algorithm; all rounds share it and reuse the cached FFT plans
+    return scipy.fft.next_fast_len(-(-mx // ds)), scipy.fft.next_fast_len(-(-my // ds), real=True)
+
+
+def read_small(f, ds, grid):
+    # read every ds-th pixel through a zarr view of the TIF without decoding the full frame into memory
+    # the samples are 0-padded to the FFT grid and cast in a single copy,
+    # single precision halves FFT memory traffic, the peak location does not need float64
+    small = np.zeros(grid, dtype=np.float32)
+    with tifffile.imread(f, aszarr=True, key=0) as store:
+        z = zarr.open(store, mode='r')[0::ds, 0::ds]
+    small[:z.shape[0], :z.shape[1]] = z
+    return small
 
 
 def get_max_frame_size(tif_files):
@@ -58,9 +153,19 @@ def get_max_frame_size(tif_files):
     maxy = 0
     minx = np.inf
     miny = np.inf
+    shapes = dict()
+    rows = dict()
     for f in tif_files:
-        tif = tifffile.TiffFile(f)
-        x, y = tif.pages[0].shape[0:2]
+        # keep the header info so frames are not re-parsed before reading
+        # and the rows of a strip or tile row, the smallest unit a frame is decoded in,
+        # unaligned uncompressed frames are read by read_frame in one block
+        with tifffile.TiffFile(f, is_ome=False) as tif:
+            page = tif.pages[0]
+            shapes[f] = (page.shape, page.dtype)
+            x, y = page.shape[0:2]
+            rows[f] = page.tilelength if page.is_tiled else min(page.rowsperstrip, x)
+            if page.is_contiguous and not page.is_memmappable:
+                rows[f] = x
         print(x, y, f)
         maxx = max(maxx,x)
         maxy = max(maxy,y)
@@ -70,32 +175,96 @@ def get_max_frame_size(tif_files):
     print('Max xy (output frame size):',maxx,maxy)
     print('Min xy:',minx,miny)
     print('Difference xy:',maxx-minx,maxy-miny,np.round((maxx-minx)/maxx,2),np.round((maxy-miny)/maxy,2))
-    return maxx, maxy        
+    return maxx, maxy, shapes, rows
+
+
+def subpixel_peak(cc, peak):
+    # sub-pixel offset of the cross-correlation peak
+    # a parabola through the peak and its two neighbours along each axis, wrapping at the borders
+    # the peak is about a pixel wide, so samples further out would only pull the vertex back to the peak
+    rows = np.arange(peak[0]-1, peak[0]+2)
+    cols = np.arange(peak[1]-1, peak[1]+2)
+    p = cc.take(rows, axis=0, mode='wrap').take(cols, axis=1, mode='wrap')
+    offset = np.zeros(2)
+    dy = p[0,1] - 2*p[1,1] + p[2,1]
+    dx = p[1,0] - 2*p[1,1] + p[1,2]
+    if dy < 0:
+        offset[0] = 0.5 * (p[0,1] - p[2,1]) / dy
+    if dx < 0:
+        offset[1] = 0.5 * (p[1,0] - p[1,2]) / dx
+    return offset
+
+
+def half_weights(n):
+    # number of columns of the full spectrum each rfft column stands for, n is the real axis length
+    w = np.full(n // 2 + 1, 2.0)
+    w[0] = 1
+    if n % 2 == 0:
+        w[-1] = 1
+    return w
+
+
+def spectrum_power(F, n):
+    # sum of squares of a real frame from its rfft2 (Parseval), n is the frame's last axis length
+    return np.sum((np.abs(F)**2) @ half_weights(n).astype(np.float32)) / (F.shape[0] * n)
+
+
+def phase_correlation(F_fix, src_amp, im_mov):
+    # phase correlation of a moving frame against the rfft2 of the fixed frame and its sum of squares
+    # returns the shift registering the moving frame to the fixed one and an error estimate
+    n0, n1 = im_mov.shape
+    F_mov = scipy.fft.rfft2(im_mov, workers=-1)
+    target_amp = spectrum_power(F_mov, n1)
 
+    # the cross-power spectrum is built in place in the moving spectrum,
+    # its phase normalised copy locates the peak
+    cross = F_mov
+    np.conjugate(cross, out=cross)
+    cross *= F_fix
+    mag = np.abs(cross)
+    mag += 1e-12
+    cc = scipy.fft.irfft2(cross / mag, s=im_mov.shape, workers=-1, overwrite_x=True)
+    peak = np.unravel_index(np.argmax(cc), cc.shape)
 
+    shift = peak + subpixel_peak(cc, peak)
 
-def main(in_folder, out_folder):
+    # shifts beyond the midpoint wrap around to negative shifts
+    dims = np.array(cc.shape)
+    shift[shift > dims // 2] -= dims[shift > dims // 2]
+
+    # error as reported by register_translation: the unnormalised cross-correlation at the peak,
+    # a single inverse DFT sample of the cross-power spectrum, against the energies of both frames
+    a = np.exp(2j * np.pi * np.arange(n0) * peak[0] / n0)
+    b = np.exp(2j * np.pi * np.arange(n1 // 2 + 1) * peak[1] / n1) * half_weights(n1)
+    CCmax = np.real(a @ (cross @ b.astype(cross.dtype))) / (n0 * n1)
+    error = np.sqrt(np.abs(1 - CCmax**2 / (src_amp * target_amp)))
+    return shift, error
+
+
+
+def main(in_folder, out_folder, backend='numpy'):
 
     # scan all files for largest images size
     tif_files = glob2.glob(os.path.join(in_folder, '*.tif'))
     
-    # check memory
-    mem = psutil.virtual_memory()
-    tif1 = tifffile.TiffFile(tif_files[0])
-    tif2 = tifffile.TiffFile(tif_files[1])
-    tsz1 = tif1.fstat.st_size
-    tsz2 = tif2.fstat.st_size
-    if (tsz1 + tsz2) > mem.available * 0.75:
-        print('Not enough memory to read two frames.')
-        exit()
-    
-    
+    # parse round id and marker of each file in a single pass
+    # <anything>.<ROUND ID>.<marker>.tif
+    round_ids = dict()
+    dapis = []
+    tifs = dict()
+    for x in tif_files:
+        r, marker = os.path.basename(x).rsplit('.', 3)[-3:-1]
+        round_ids[x] = r
+        tifs.setdefault(r, [])
+        if marker.lower() == 'dapi':
+            dapis.append(x)
+        else:
+            tifs[r].append(x)
+
     # show round and file info
-    rounds = list(set([os.path.basename(x).split('.')[-3] for x in tif_files]))
+    rounds = list(tifs)
     max_rounds = max(rounds)
     print('Imaging rounds:', rounds)
-
-    dapis = [x for x in tif_files if os.path.basename(x).split('.')[-2].lower()=='dapi']
     print('Number of DAPI frames:', len(dapis))
  
     if not str(len(dapis)) == max_rounds:
@@ -105,40 +274,59 @@ def main(in_folder, out_folder):
         print('At least two DAPI frames needed for registration.')
         exit()
     
-    tifs = dict()
-    for r in rounds:
-        a = [x for x in tif_files if os.path.basename(x).split('.')[-3]==r and not os.path.basename(x).split('.')[-2].lower()=='dapi']
-        tifs[r] = a
-    
     # largest image size
-    mx,my = get_max_frame_size(tif_files)
+    mx,my,shapes,rows = get_max_frame_size(tif_files)
+
+    # one writer per frame of a round, at most 8
+    workers = min(8, 1 + max(len(a) for a in tifs.values()))
+
+    # check memory against the decoded sizes, the file size underestimates compressed frames
+    # every frame is decoded one strip or tile row at a time, a decoded chunk and its copy are held
+    # at once by the reader, by every writer and by read_frame, which on the numpy backend also
+    # holds a padded fixed round frame, one at a time
+    mem = psutil.virtual_memory()
+    tsz = mx * my * max(dtype.itemsize * int(np.prod(shape[2:])) for shape, dtype in shapes.values())
+    csz = 2 * max(rows[f] * dtype.itemsize * int(np.prod(shape[1:])) for f, (shape, dtype) in shapes.items())
+    if csz + max(tsz + csz if backend == 'numpy' else csz, workers * csz) > mem.available * 0.75:
+        print('Not enough memory to read the frames.')
+        exit()
     
     # adjust all histograms of all frames might help
     
     # write fixed files
     fix_dapi = dapis.pop()
-    fix_id = os.path.basename(fix_dapi).split('.')[-3]
+    fix_id = round_ids[fix_dapi]
     fix_frames = tifs[fix_id]
     
-    for f in fix_frames:
-        im = tifffile.imread(f)
-        im = np.squeeze(im)
-        im = pad_frame(im, mx, my)
-        tifffile.imwrite(f.replace('input','output'),data=im)
-        
-    # read fixed dapi only once
-    im_fix = tifffile.imread(fix_dapi)
-    im_fix = np.squeeze(im_fix)
-    im_fix = pad_frame(im_fix, mx, my)
+    # registration only needs the down sampled dapi frames
+    down_sample = max(mx, my) // 10000 + 1    
+    grid = fft_grid(mx, my, down_sample)
+
+    # down sampled dapi frames are read in the background one round ahead,
+    # overlapping their IO with the writes of the previous round
+    reader = ThreadPoolExecutor(max_workers=1)
+    fix_small = reader.submit(read_small, fix_dapi, down_sample, grid)
+    mov_small = reader.submit(read_small, dapis[-1], down_sample, grid)
+
+    # one writer pool for all rounds
+    writer = ThreadPoolExecutor(max_workers=workers)
 
-    # write fixed dapi frame
-    tifffile.imwrite(fix_dapi.replace('input','output'),data=im_fix)
+    for f in [fix_dapi] + fix_frames:
+        if backend == 'vips':
+            write_shifted_vips(f, 0, 0, mx, my)
+        else:
+            im = read_frame(f, mx, my, *shapes[f])
+            write_frame(f.replace('input','output'), im)
+        
+    im_fix_small = fix_small.result()
     
-    down_sample = max(im_fix.shape) // 10000 + 1    
-    im_fix_small = im_fix[0::down_sample, 0::down_sample]
+    # the fixed spectrum and its error normaliser are shared by all rounds
+    F_fix = scipy.fft.rfft2(im_fix_small, workers=-1)
+    src_amp = spectrum_power(F_fix, im_fix_small.shape[1])
     
-    print('Fixed DAPI frame:', im_fix.shape, fix_dapi)
-    print('Down sample factor:', down_sample, '\n')
+    print('Fixed DAPI frame:', (mx, my), fix_dapi)
+    print('Down sample factor:', down_sample)
+    print('FFT grid:', grid, '\n')
 
     errors = dict()
     for r in rounds:
@@ -146,37 +334,34 @@ def main(in_folder, out_folder):
     
     while dapis:
         mov_dapi = dapis.pop()
-        mov_id = os.path.basename(mov_dapi).split('.')[-3]
+        mov_id = round_ids[mov_dapi]
         mov_frames = tifs[mov_id]
         
-        # read the moving frame
-        im_mov = tifffile.imread(mov_dapi)
-        im_mov = np.squeeze(im_mov)
-        im_mov = pad_frame(im_mov, mx, my)
-        im_mov_small = im_mov[0::down_sample, 0::down_sample]
+        # down sampled moving frame, queue the next round's read
+        im_mov_small = mov_small.result()
+        if dapis:
+            mov_small = reader.submit(read_small, dapis[-1], down_sample, grid)
         
         print('Registering round:', mov_id)
         
-        shift, error, diffphase = register_translation(im_fix_small, im_mov_small, upsample_factor=down_sample)
+        shift, error = phase_correlation(F_fix, src_amp, im_mov_small)
         
         shift = shift * [down_sample, down_sample]
 
         errors[mov_id] = error
 
-        print('DAPI frame:', im_mov.shape, mov_dapi, 'error: {:.2f}'.format(error), 'phase: {:.4E}'.format(diffphase))
+        print('DAPI frame:', mov_dapi, 'error: {:.2f}'.format(error))
 
-        im_mov_shifted = np.roll(im_mov, shift.astype(int), [0,1])
-        print('Writing:', im_mov_shifted.shape, mov_dapi.replace('input','output'))
-        tifffile.imwrite(mov_dapi.replace('input','output'), data=im_mov_shifted)
+        # translate the dapi and all non-dapi channels in this round
+        # frames are independent, IO and copies overlap across threads
+        # the log is written from this thread only, so lines of concurrent writes do not interleave
+        dy, dx = np.round(shift).astype(int)
+        write = write_shifted_vips if backend == 'vips' else write_shifted
+        for out in writer.map(lambda f: write(f, dy, dx, mx, my), [mov_dapi] + mov_frames):
+            print('Written:', (mx, my), out)
 
-        # translate all non-dapi channels in this round
-        for f in mov_frames:
-            im = tifffile.imread(f)
-            im = np.squeeze(im)
-            im = pad_frame(im, mx, my)
-            im = np.roll(im, shift.astype(int), [0,1])
-            print('Writing:', im.shape, f.replace('input','output'))
-            tifffile.imwrite(f.replace('input','output'), data=im)
+    reader.shutdown()
+    writer.shutdown()
 
     # print errors
     print('\nErrors:')
@@ -187,10 +372,15 @@ def main(in_folder, out_folder):
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description='Register the rounds of a multiplexed image.')
+    parser.add_argument('--backend', choices=['numpy', 'vips'], default='numpy',
+                        help='vips streams frames through libvips instead of loading them into memory')
+    args = parser.parse_args()
+
     log_file = 'output/output.log'
     sys.stdout = open(log_file, 'a')
 
     print('\nProcess started:', sys.argv[0],'\n')
 
-    main('input/','output/')
+    main('input/','output/', backend=args.backend)
 